@@ -728,7 +728,7 @@ export function ConversationTreeChatbot() {
         timestamp: node.timestamp.toISOString(),
       }));
 
-      const response = await fetch('http://localhost:8000/api/chat', {
+      const postChat = (includeTree: boolean) => fetch('http://localhost:8000/api/chat', {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -737,13 +737,22 @@ export function ConversationTreeChatbot() {
           session_id: 'default', // You might want to make this dynamic
           user_message: promptText,
           parent_node_id: treeData.activeNodeId,
-          tree: {
-            session_id: 'default',
-            nodes: nodesForAPI,
-          },
+          include_context_image: false, // not displayed; available from /api/context_image
+          ...(includeTree && {
+            tree: {
+              session_id: 'default',
+              nodes: nodesForAPI,
+            },
+          }),
         }),
       });
 
+      // The backend keeps the tree per session, so only send ours if it lost track (e.g. after a restart)
+      let response = await postChat(false);
+      if (response.status === 409) {
+        response = await postChat(true);
+      }
+
       if (!response.ok) {
         let errorMessage = 'Failed to get response';
         try {
@@ -755,55 +764,78 @@ export function ConversationTreeChatbot() {
         throw new Error(errorMessage);
       }
 
-      const data = await response.json();
-
-      const fullResponse = data.response;
-      const nodeId = data.node_id;
-      
-      let currentText = '';
-      const streamInterval = setInterval(() => {
-        if (currentText.length < fullResponse.length) {
-          currentText = fullResponse.substring(0, currentText.length + 3);
-          setStreamingResponses(prev => {
-            const newMap = new Map(prev);
-            newMap.set(tempNodeId, currentText);
-            return newMap;
-          });
-        } else {
-          clearInterval(streamInterval);
-          
-          // Transfer the locked position from tempNodeId to actual nodeId
-          const tempPosition = lockedPositions.get(tempNodeId);
-          if (tempPosition) {
-            lockedPositions.set(nodeId, tempPosition);
-            lockedPositions.delete(tempNodeId);
+      // The reply is streamed as server-sent events: {delta} chunks, then a final {done, node_id, ...}
+      const reader = response.body!.getReader();
+      const decoder = new TextDecoder();
+      let buffered = '';
+      let fullResponse = '';
+      let nodeId = '';
+
+      while (!nodeId) {
+        const { done, value } = await reader.read();
+        if (done) {
+          throw new Error('Response stream ended unexpectedly');
+        }
+        buffered += decoder.decode(value, { stream: true });
+        const events = buffered.split('\n\n');
+        buffered = events.pop() || '';
+
+        for (const event of events) {
+          if (!event.startsWith('data: ')) continue;
+          const data = JSON.parse(event.slice('data: '.length));
+          if (data.error) {
+            throw new Error(data.error);
+          }
+          if (data.done) {
+            nodeId = data.node_id;
+            fullResponse = data.response;
+          } else {
+            fullResponse += data.delta;
+            const currentText = fullResponse;
+            setStreamingResponses(prev => {
+              const newMap = new Map(prev);
+              newMap.set(tempNodeId, currentText);
+              return newMap;
+            });
           }
-          
-          setTreeData((prev) => ({
-            ...prev,
-            nodes: prev.nodes.map(node =>
-              node.id === tempNodeId
-                ? {
-                    ...node,
-                    id: nodeId,
-                    response: fullResponse,
-                  }
-                : node
-            ),
-            activeNodeId: nodeId,
-          }));
-          setStreamingResponses(prev => {
-            const newMap = new Map(prev);
-            newMap.delete(tempNodeId);
-            return newMap;
-          });
         }
-      }, 20);
+      }
+
+      // Transfer the locked position from tempNodeId to actual nodeId
+      const tempPosition = lockedPositions.get(tempNodeId);
+      if (tempPosition) {
+        lockedPositions.set(nodeId, tempPosition);
+        lockedPositions.delete(tempNodeId);
+      }
+
+      setTreeData((prev) => ({
+        ...prev,
+        nodes: prev.nodes.map(node =>
+          node.id === tempNodeId
+            ? {
+                ...node,
+                id: nodeId,
+                response: fullResponse,
+              }
+            : node
+        ),
+        activeNodeId: nodeId,
+      }));
+      setStreamingResponses(prev => {
+        const newMap = new Map(prev);
+        newMap.delete(tempNodeId);
+        return newMap;
+      });
 
       focusNode(nodeId);
     } catch (error) {
       console.error('Error sending message:', error);
       const errorMessage = error instanceof Error ? error.message : 'Failed to get response';
+      setStreamingResponses(prev => {
+        const newMap = new Map(prev);
+        newMap.delete(tempNodeId);
+        return newMap;
+      });
       
       if (errorMessage.includes('fetch') || errorMessage.includes('Failed to fetch')) {
         setTreeData((prev) => ({
@@ -1,22 +1,64 @@
 
 import os
-import json
-from typing import List, Dict, Optional, Tuple
-from fastapi import FastAPI, HTTPException
+import asyncio
+import logging
+import threading
+import time
+import traceback
+import uuid
+import hashlib
+import multiprocessing
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, List, Dict, Optional, Tuple
+import msgspec
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse, Response
-from pydantic import BaseModel
-from gemini_image_context_chat import GeminiImageContextChat, ImageContextStorage
+from fastapi.responses import Response, StreamingResponse
+from gemini_image_context_chat import GeminiImageContextChat, ImageContextStorage, text_tokens_for_texts, vision_tokens_for_size
 from PIL import Image
 import base64
 from io import BytesIO
 from datetime import datetime
 
-app = FastAPI(title="Gemini Image Context Chat API")
+class MsgspecJSONResponse(Response):
+    """JSON response encoded with msgspec instead of json.dumps (stats responses carry the full call log)."""
+    media_type = "application/json"
+    
+    def render(self, content: Any) -> bytes:
+        return msgspec.json.encode(content)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start the worker pools and the session sweeper with the server, and stop them with it."""
+    global render_pool
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=WORKER_THREADS))
+    # spawn rather than fork, the server process already runs threads
+    render_pool = ProcessPoolExecutor(max_workers=RENDER_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+    session_sweeper = asyncio.create_task(run_session_sweeper())
+    try:
+        yield
+    finally:
+        session_sweeper.cancel()
+        render_pool.shutdown(wait=False, cancel_futures=True)
+        render_pool = None
 
-# create context images directory
+
+app = FastAPI(title="Gemini Image Context Chat API", default_response_class=MsgspecJSONResponse, lifespan=lifespan)
+
+# per-request detail is logged at DEBUG; set CLARITY_LOG_LEVEL=DEBUG to see it
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=os.environ.get("CLARITY_LOG_LEVEL", "WARNING").upper())
+
+# rendered context images are only written to disk for debugging, when
+# CLARITY_PERSIST_CONTEXT_IMAGES is set; responses never depend on the files
 CONTEXT_IMAGES_DIR = "context_images"
-os.makedirs(CONTEXT_IMAGES_DIR, exist_ok=True)
+PERSIST_CONTEXT_IMAGES = os.environ.get("CLARITY_PERSIST_CONTEXT_IMAGES", "").lower() in ("1", "true", "yes")
+if PERSIST_CONTEXT_IMAGES:
+    os.makedirs(CONTEXT_IMAGES_DIR, exist_ok=True)
 
 app.add_middleware(
     CORSMiddleware,
@@ -28,10 +70,45 @@ app.add_middleware(
 
 chat_sessions: Dict[str, GeminiImageContextChat] = {}
 
-token_stats: Dict[str, List[Dict]] = {}
+# sessions idle for SESSION_TTL_SECONDS are dropped, as are the least recently used ones
+# once more than MAX_SESSIONS are live; ordered least recently used first
+MAX_SESSIONS = 10_000
+SESSION_TTL_SECONDS = 3600
+SESSION_SWEEP_SECONDS = 60  # how often expired sessions are dropped when no requests arrive
+session_last_used: "OrderedDict[str, float]" = OrderedDict()
+
+# a session's first chat opens its Gemini connection in the background while the context
+# image renders, rather than waiting for it; the tasks are kept referenced here
+session_warmups: Dict[str, asyncio.Task] = {}
 
+# per-session call log plus running totals, so /api/stats never re-sums the calls;
+# the log is stored column-wise (one packed array per field) rather than as a dict per call
+token_stats: Dict[str, Dict] = {}
+CALL_STAT_FIELDS = ('vision_tokens', 'text_tokens', 'text_equivalent_tokens', 'token_savings')
 
-class NodePath(BaseModel):
+# rendered context images keyed by a digest of the path's messages (see path_digest), least
+# recently used first; identical histories share an entry across branches and sessions
+# values are (image, vision_tokens, encoded image bytes); once a path has been extended the
+# image is dropped when the bytes decode back to it exactly (see LOSSLESS_IMAGE_FORMATS)
+# the cache holds at most CONTEXT_IMAGE_CACHE_BYTES of raw pixels plus encoded bytes
+CONTEXT_IMAGE_CACHE_BYTES = 256 * 1024 * 1024
+context_image_cache: "OrderedDict[bytes, Tuple[Optional[Image.Image], int, bytes]]" = OrderedDict()
+context_image_cache_bytes = 0
+context_image_cache_lock = threading.Lock()  # rendering runs on worker threads
+
+# blocking PIL and disk work is offloaded to this many threads
+WORKER_THREADS = 64
+
+# whole-tree renders for /api/stats/calculate are CPU-bound for seconds on big trees,
+# so they run in worker processes instead of contending for the GIL with requests
+RENDER_PROCESSES = os.cpu_count() or 1
+render_pool: Optional[ProcessPoolExecutor] = None
+
+
+# request/response bodies that carry the conversation tree are msgspec structs decoded
+# straight from the raw body; validating large trees through Pydantic on every call
+# dominates request handling
+class NodePath(msgspec.Struct):
     node_id: str
     parent_id: Optional[str]
     prompt: str
@@ -39,19 +116,22 @@ class NodePath(BaseModel):
     timestamp: str
 
 
-class ConversationTree(BaseModel):
+class ConversationTree(msgspec.Struct):
     session_id: str
     nodes: List[NodePath]
 
 
-class MessageRequest(BaseModel):
+class MessageRequest(msgspec.Struct, kw_only=True):
     session_id: str
     user_message: str
     parent_node_id: Optional[str] = None  # the node to branch from (null for root)
-    tree: ConversationTree  
+    # the server keeps each session's tree; clients only resend it when /api/chat answers 409
+    tree: Optional[ConversationTree] = None
+    # clients that don't display the context image can skip it and fetch /api/context_image on demand
+    include_context_image: bool = True
 
 
-class MessageResponse(BaseModel):
+class MessageResponse(msgspec.Struct):
     node_id: str
     response: str
     vision_tokens: int
@@ -59,9 +139,26 @@ class MessageResponse(BaseModel):
     text_equivalent_tokens: int
     token_savings: int
     context_image_base64: Optional[str] = None
+    context_image_format: Optional[str] = None  # e.g. "webp", for a data:image/<format> URL
+
+
+message_request_decoder = msgspec.json.Decoder(MessageRequest)
+json_encoder = msgspec.json.Encoder()
+
+
+def sse_event(payload: Any) -> bytes:
+    # every /api/chat stream event goes through the same msgspec encoder
+    return b"data: " + json_encoder.encode(payload) + b"\n\n"
 
 
-class TokenStatsResponse(BaseModel):
+async def decode_body(request: Request, decoder: msgspec.json.Decoder):
+    try:
+        return decoder.decode(await request.body())
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+class TokenStatsResponse(msgspec.Struct):
     session_id: str
     total_api_calls: int
     total_vision_tokens: int
@@ -73,105 +170,533 @@ class TokenStatsResponse(BaseModel):
     calls: List[Dict]
 
 
-class BranchContextRequest(BaseModel):
-    session_id: str
-    node_path: List[str]  # list of node IDs from root to target node
+# per-session node lookup, kept in sync with the client's tree incrementally
+session_node_index: Dict[str, Dict[str, NodePath]] = {}
+session_node_order: Dict[str, List[str]] = {}  # node IDs in the order they were indexed
+session_parent_of: Dict[str, Dict[str, Optional[str]]] = {}  # node ID -> parent node ID
+session_path_cache: Dict[str, Dict[str, List[str]]] = {}  # node ID -> path from root
+session_node_chars: Dict[str, Dict[str, int]] = {}  # node ID -> len(prompt) + len(response)
+session_path_chars: Dict[str, Dict[str, int]] = {}  # node ID -> characters on its path from root
+session_path_digests: Dict[str, Dict[str, bytes]] = {}  # node ID -> path_digest of its path
+
+# whole-tree image from /api/stats/calculate as (messages rendered, image), extended in
+# place of a full re-render while the client only appends messages
+session_tree_image: Dict[str, Tuple[List[Dict[str, str]], Image.Image]] = {}
+
+
+def new_token_stats() -> Dict:
+    return {
+        'node_ids': [],
+        'timestamps': array('d'),
+        **{field: array('q') for field in CALL_STAT_FIELDS},
+        'total_vision': 0,
+        'total_text': 0,
+        'total_text_equiv': 0,
+        'total_savings': 0,
+    }
+
+
+def record_call_stats(session_id: str, call_stats: Dict):
+    stats = token_stats.get(session_id)
+    if stats is None:
+        return  # deleted or evicted while the reply was streaming
+    stats['node_ids'].append(call_stats['node_id'])
+    stats['timestamps'].append(call_stats['timestamp'])
+    for field in CALL_STAT_FIELDS:
+        stats[field].append(call_stats[field])
+    stats['total_vision'] += call_stats['vision_tokens']
+    stats['total_text'] += call_stats['text_tokens']
+    stats['total_text_equiv'] += call_stats['text_equivalent_tokens']
+    stats['total_savings'] += call_stats['token_savings']
+
+
+def call_stats_log(stats: Dict) -> List[Dict]:
+    """Rebuild the per-call dicts from the column-wise log, only when a response needs them."""
+    return [
+        {'node_id': node_id, **dict(zip(CALL_STAT_FIELDS, values)), 'timestamp': timestamp}
+        for node_id, timestamp, *values in zip(
+            stats['node_ids'], stats['timestamps'], *(stats[field] for field in CALL_STAT_FIELDS)
+        )
+    ]
+
+
+def drop_session(session_id: str):
+    chat_sessions.pop(session_id, None)
+    session_warmups.pop(session_id, None)
+    token_stats.pop(session_id, None)
+    session_last_used.pop(session_id, None)
+    session_node_index.pop(session_id, None)
+    session_node_order.pop(session_id, None)
+    session_parent_of.pop(session_id, None)
+    session_path_cache.pop(session_id, None)
+    session_node_chars.pop(session_id, None)
+    session_path_chars.pop(session_id, None)
+    session_path_digests.pop(session_id, None)
+    session_tree_image.pop(session_id, None)
+
+
+def touch_session(session_id: str):
+    """Mark a session as just used and drop any sessions that expired or overflow the limit."""
+    now = time.monotonic()
+    session_last_used[session_id] = now
+    session_last_used.move_to_end(session_id)
+    evict_idle_sessions(now)
+
+
+def evict_idle_sessions(now: float):
+    expired = []
+    for idle_id, last_used in session_last_used.items():
+        if len(session_last_used) - len(expired) <= MAX_SESSIONS and now - last_used < SESSION_TTL_SECONDS:
+            break
+        expired.append(idle_id)
+    for idle_id in expired:
+        logger.info("[Sessions] Evicting idle session %s", idle_id)
+        drop_session(idle_id)
+
+
+async def warm_up_session(chat: GeminiImageContextChat):
+    # count_tokens is free and sets up the async client connection without generating anything
+    try:
+        await chat.model.count_tokens_async("ping")
+    except Exception as e:
+        logger.warning("[Warmup] Gemini warmup failed: %s", e)
+
+
+def start_session_warmup(session_id: str, chat: GeminiImageContextChat):
+    # only chats use the connection, so only they start it (once per session)
+    if session_id not in session_warmups:
+        session_warmups[session_id] = asyncio.get_running_loop().create_task(warm_up_session(chat))
+
+
+def get_or_create_session_tree(session_id: str):
+    """Mark a session as used and set up its tree index and stats, without a Gemini client."""
+    touch_session(session_id)
+    if session_id not in session_node_index:
+        token_stats[session_id] = new_token_stats()
+        session_node_index[session_id] = {}
+        session_node_order[session_id] = []
+        session_parent_of[session_id] = {}
+        session_path_cache[session_id] = {}
+        session_node_chars[session_id] = {}
+        session_path_chars[session_id] = {}
+        session_path_digests[session_id] = {}
 
 
 def get_or_create_session(session_id: str) -> GeminiImageContextChat:
+    get_or_create_session_tree(session_id)
     if session_id not in chat_sessions:
         api_key = os.environ.get('GEMINI_API_KEY')
         if not api_key:
             raise HTTPException(status_code=500, detail="GEMINI_API_KEY not set")
-        chat_sessions[session_id] = GeminiImageContextChat(api_key)
-        token_stats[session_id] = []
+        chat_sessions[session_id] = GeminiImageContextChat(
+            api_key,
+            context_images_dir=CONTEXT_IMAGES_DIR if PERSIST_CONTEXT_IMAGES else None,
+            image_storage=context_image_storage
+        )
     return chat_sessions[session_id]
 
 
-def get_path_context(node_path: List[str], all_nodes: List[NodePath]) -> List[Dict[str, str]]:
-    if not node_path:
-        return []
+def sync_node_index(session_id: str, nodes: List[NodePath]) -> Dict[str, NodePath]:
+    """
+    Bring the session's node index up to date with the tree sent by the client.
+
+    The client mostly appends nodes between chat calls, so normally just the new
+    tail is inserted. If the indexed prefix no longer matches (nodes were deleted, or
+    the client rewrote a node under the same ID), the index and memoized paths are
+    rebuilt from scratch, into new dicts: chats still rendering or streaming hold on
+    to the old ones.
+    """
+    order = session_node_order.get(session_id, [])
+    node_map = session_node_index.get(session_id, {})
+    indexed = len(order)
+    if indexed and (len(nodes) < indexed or any(
+        node.node_id != node_id or not same_node_content(node, node_map[node_id])
+        for node, node_id in zip(nodes, order)
+    )):
+        session_node_index[session_id] = {}
+        session_node_order[session_id] = []
+        session_parent_of[session_id] = {}
+        session_path_cache[session_id] = {}
+        session_node_chars[session_id] = {}
+        session_path_chars[session_id] = {}
+        session_path_digests[session_id] = {}
+        indexed = 0
     
-    # creates a map with node IDs as keys
-    node_map = {node.node_id: node for node in all_nodes}
+    node_map = session_node_index.setdefault(session_id, {})
+    order = session_node_order.setdefault(session_id, [])
+    parent_of = session_parent_of.setdefault(session_id, {})
+    session_path_cache.setdefault(session_id, {})
+    node_chars = session_node_chars.setdefault(session_id, {})
+    session_path_chars.setdefault(session_id, {})
+    session_path_digests.setdefault(session_id, {})
     
-    messages = []
-    for node_id in node_path:
-        if node_id in node_map:
-            node = node_map[node_id]
-            messages.append({'role': 'user', 'content': node.prompt})
-            messages.append({'role': 'model', 'content': node.response})
+    for node in nodes[indexed:]:
+        node_map[node.node_id] = node
+        order.append(node.node_id)
+        parent_of[node.node_id] = node.parent_id
+        node_chars[node.node_id] = len(node.prompt) + len(node.response)
+    return node_map
+
+
+def same_node_content(node: NodePath, indexed: NodePath) -> bool:
+    # timestamps are left out, the client formats its own
+    return node.parent_id == indexed.parent_id and node.prompt == indexed.prompt and node.response == indexed.response
+
+
+def snapshot_turn_context(session_id: str, tree: Optional[ConversationTree], parent_node_id: Optional[str]) -> Tuple[List[str], Dict[str, NodePath], Dict[str, bytes], int]:
+    """
+    Sync the index with the client's tree (when sent) and read what a turn needs from it.
     
-    return messages
+    This is one synchronous step, so no other request can resync the index between the
+    path being resolved and its digests and size being read. The turn only uses what is
+    returned (path, node map, digest dict, path characters), which stays consistent when
+    a later resync swaps in new dicts while it renders or streams.
+    """
+    if tree is not None:
+        node_map = sync_node_index(session_id, tree.nodes)
+    else:
+        node_map = session_node_index[session_id]
+        if parent_node_id and parent_node_id not in node_map:
+            # e.g. the server restarted; the client has to send its copy of the tree
+            raise HTTPException(status_code=409, detail="Unknown parent node, resend the request with the tree")
+    node_path = resolve_node_path(session_id, parent_node_id)
+    path_digests = session_path_digests[session_id]
+    path_chars = session_path_chars[session_id][node_path[-1]] if node_path else 0
+    return node_path, node_map, path_digests, path_chars
+
+
+def add_tree_node(session_id: str, node: NodePath):
+    """
+    Record a node created by /api/chat in the server-side tree.
+    
+    Its root path, path character count and path digest are memoized straight away
+    from the parent's, so the next turn replying to this node never has to walk the tree.
+    The replies stream for a while, so the parent's path is looked up again here
+    rather than reused from the start of the request: a resync with the client's
+    tree may have rebuilt the index, or the session may be gone altogether.
+    """
+    if session_id not in session_node_index:
+        return  # deleted or evicted while the reply was streaming
+    parent_path = resolve_node_path(session_id, node.parent_id)
+    chars = len(node.prompt) + len(node.response)
+    session_node_index[session_id][node.node_id] = node
+    session_node_order[session_id].append(node.node_id)
+    session_parent_of[session_id][node.node_id] = node.parent_id
+    session_node_chars[session_id][node.node_id] = chars
+    session_path_cache[session_id][node.node_id] = parent_path + [node.node_id]
+    parent_chars = session_path_chars[session_id][parent_path[-1]] if parent_path else 0
+    session_path_chars[session_id][node.node_id] = parent_chars + chars
+    parent_digest = session_path_digests[session_id][parent_path[-1]] if parent_path else b""
+    session_path_digests[session_id][node.node_id] = path_digest(parent_digest, node)
+
+
+def path_digest(parent_digest: bytes, node: NodePath) -> bytes:
+    """
+    Digest of the messages on a path, chained from the parent path's digest.
+    
+    Chaining makes every prefix of a path addressable too, and each node's text is
+    only hashed once. Node IDs are left out, so equal histories get equal digests.
+    """
+    digest = hashlib.blake2b(parent_digest, digest_size=16)
+    digest.update(node.prompt.encode('utf-8'))
+    digest.update(b"\x1f")  # separates prompt from response
+    digest.update(node.response.encode('utf-8'))
+    digest.update(b"\x1e")
+    return digest.digest()
+
+
+def resolve_node_path(session_id: str, node_id: Optional[str]) -> List[str]:
+    """
+    Return the node IDs from the root down to node_id.
+    
+    Every path resolved on the way is memoized, along with the running character
+    count and digest of its messages, so a node's context size and cache key are
+    single lookups afterwards.
+    """
+    node_map = session_node_index[session_id]
+    parent_of = session_parent_of[session_id]
+    path_cache = session_path_cache[session_id]
+    node_chars = session_node_chars[session_id]
+    path_chars = session_path_chars[session_id]
+    path_digests = session_path_digests[session_id]
+    
+    # walk up until the root or a node whose path is already known
+    pending = []
+    path: List[str] = []
+    chars = 0
+    digest = b""
+    current_id = node_id
+    while current_id and current_id in parent_of:
+        if current_id in path_cache:
+            path = path_cache[current_id]
+            chars = path_chars[current_id]
+            digest = path_digests[current_id]
+            break
+        pending.append(current_id)
+        current_id = parent_of[current_id]
+    
+    for pending_id in reversed(pending):
+        path = path + [pending_id]
+        chars += node_chars[pending_id]
+        digest = path_digest(digest, node_map[pending_id])
+        path_cache[pending_id] = path
+        path_chars[pending_id] = chars
+        path_digests[pending_id] = digest
+    return path
+
+
+def get_path_context(node_path: List[str], node_map: Dict[str, NodePath]) -> List[Dict[str, str]]:
+    # only called for nodes that are about to be rendered; sizes come from session_path_chars
+    return [
+        message
+        for node in map(node_map.__getitem__, node_path)
+        for message in ({'role': 'user', 'content': node.prompt}, {'role': 'model', 'content': node.response})
+    ]
+
+
+# codec for the context image returned to the client, and sent to Gemini as is when lossless
+# (see GEMINI_IMAGE_FORMATS); text on white is flat colour, which lossless WebP and a
+# small-palette PNG handle far better than lossy WebP (about a fifth of the bytes, and
+# several times faster)
+CONTEXT_IMAGE_ENCODINGS = {
+    "WEBP": {"lossless": True, "method": 0},
+    "PNG": {"compress_level": 3},
+    "BMP": {},
+}
+CONTEXT_IMAGE_PNG_COLORS = 16  # PNGs are quantized to a palette first
+CONTEXT_IMAGE_FORMAT = os.environ.get("CLARITY_CONTEXT_IMAGE_FORMAT", "WEBP").upper()
+if CONTEXT_IMAGE_FORMAT not in CONTEXT_IMAGE_ENCODINGS:
+    raise ValueError(f"CLARITY_CONTEXT_IMAGE_FORMAT must be one of {', '.join(CONTEXT_IMAGE_ENCODINGS)}")
+# codecs whose bytes decode back to exactly the rendered image (PNGs are quantized)
+LOSSLESS_IMAGE_FORMATS = ("WEBP", "BMP")
+# codecs whose cached bytes Gemini is sent as inline image data; Gemini also takes PNG, but
+# the cached PNGs are palette-quantized, so with any other codec it gets the full-colour PIL image
+GEMINI_IMAGE_FORMATS = ("WEBP",)
+
+# one reusable encode buffer per worker thread
+image_buffers = threading.local()
+
+# a single renderer shared by all sessions; rendering keeps its state in locals, so worker
+# threads can use it concurrently (fonts and wrapped lines are memoized per process)
+context_image_storage = ImageContextStorage()
+
+
+def encode_image_bytes(image: Image.Image, image_format: str = CONTEXT_IMAGE_FORMAT) -> bytes:
+    buffered = getattr(image_buffers, 'buffer', None)
+    if buffered is None:
+        buffered = image_buffers.buffer = BytesIO()
+    buffered.seek(0)
+    buffered.truncate()
+    
+    if image_format == "PNG":
+        image = image.quantize(CONTEXT_IMAGE_PNG_COLORS, method=Image.Quantize.FASTOCTREE)
+    image.save(buffered, format=image_format, **CONTEXT_IMAGE_ENCODINGS[image_format])
+    return buffered.getvalue()
+
+
+def negotiate_image_format(accept: Optional[str]) -> str:
+    """Pick the codec for an Accept header, preferring the configured one."""
+    if not accept or f"image/{CONTEXT_IMAGE_FORMAT.lower()}" in accept or "*/*" in accept or "image/*" in accept:
+        return CONTEXT_IMAGE_FORMAT
+    for image_format in CONTEXT_IMAGE_ENCODINGS:
+        if f"image/{image_format.lower()}" in accept:
+            return image_format
+    raise HTTPException(status_code=406, detail=f"Context images are available as {', '.join(CONTEXT_IMAGE_ENCODINGS)}")
+
+
+def write_image_file(image_path: str, image_bytes: bytes):
+    with open(image_path, 'wb') as f:
+        f.write(image_bytes)
+    logger.debug("Context image saved: %s", image_path)
+
+
+def save_stats_image(image: Image.Image, image_path: str):
+    # debug copy only: JPEG encodes this ~10x faster than even compress_level=1 PNG
+    image.save(image_path, format="JPEG", quality=80)
+    logger.debug("[Stats Calculation] Entire conversation image saved: %s", image_path)
+
+
+def context_image_entry_size(entry: Tuple[Optional[Image.Image], int, bytes]) -> int:
+    image, _, image_bytes = entry
+    # RGB, 3 bytes per pixel
+    return (image.width * image.height * 3 if image is not None else 0) + len(image_bytes)
+
+
+def store_context_image(key: bytes, entry: Tuple[Optional[Image.Image], int, bytes]):
+    """Insert or replace a cache entry, then evict least recently used ones over the byte budget."""
+    global context_image_cache_bytes
+    with context_image_cache_lock:
+        replaced = context_image_cache.pop(key, None)
+        if replaced is not None:
+            context_image_cache_bytes -= context_image_entry_size(replaced)
+        context_image_cache[key] = entry
+        context_image_cache_bytes += context_image_entry_size(entry)
+        # the newest entry always stays, even on its own over budget
+        while context_image_cache_bytes > CONTEXT_IMAGE_CACHE_BYTES and len(context_image_cache) > 1:
+            _, evicted = context_image_cache.popitem(last=False)
+            context_image_cache_bytes -= context_image_entry_size(evicted)
+
+
+def cached_context_image(entry: Tuple[Optional[Image.Image], int, bytes]) -> Image.Image:
+    """The entry's image, decoded from its bytes if it was dropped."""
+    if entry[0] is not None:
+        return entry[0]
+    return Image.open(BytesIO(entry[2])).convert("RGB")
 
 
-def send_message_with_context(chat: GeminiImageContextChat, context_messages: List[Dict[str, str]], user_message: str, session_id: str = "default", node_id: str = None) -> Tuple[str, Optional[Image.Image], dict]:
-    image_storage = ImageContextStorage()
+def build_context_image(image_storage: ImageContextStorage, path_digests: Dict[str, bytes], node_path: List[str], node_map: Dict[str, NodePath], need_image: bool = False) -> Tuple[Optional[Image.Image], int, bytes]:
+    """
+    Render the context image for a node path, reusing cached renders of its prefixes.
+
+    Sibling branches share every ancestor, so the longest cached prefix of the path is
+    extended with only the missing nodes instead of rendering the whole history again.
+    Messages are only built for the nodes actually rendered; a cache hit builds none.
+    The path must have been through resolve_node_path, which memoizes the digests;
+    path_digests is the session's digest dict as it was then, since a resync with the
+    client's tree may swap in a new one while this runs on a worker thread.
+    
+    Returns the image (None on a cache hit whose image was dropped, unless need_image),
+    its vision tokens and its encoded bytes.
+    """
+    key = path_digests[node_path[-1]]
+    with context_image_cache_lock:
+        cached = context_image_cache.get(key)
+        if cached is not None:
+            context_image_cache.move_to_end(key)
+    if cached is not None:
+        logger.debug("[Context Cache] Hit for path of depth %d", len(node_path))
+        image = cached_context_image(cached) if need_image else cached[0]
+        return image, cached[1], cached[2]
+    
+    # strip one node at a time until a cached prefix is found
+    context_image = None
+    for depth in range(len(node_path) - 1, 0, -1):
+        prefix_key = path_digests[node_path[depth - 1]]
+        with context_image_cache_lock:
+            prefix = context_image_cache.get(prefix_key)
+        if prefix is not None:
+            new_nodes = node_path[depth:]
+            context_image = image_storage.append_messages_to_image(cached_context_image(prefix), get_path_context(new_nodes, node_map))
+            logger.debug("[Context Cache] Extended cached prefix of depth %d to %d", depth, len(node_path))
+            # the new entry carries the image on; branching off the prefix again decodes its bytes
+            if prefix[0] is not None and CONTEXT_IMAGE_FORMAT in LOSSLESS_IMAGE_FORMATS:
+                store_context_image(prefix_key, (None, prefix[1], prefix[2]))
+            break
+    if context_image is None:
+        context_image = image_storage.messages_to_image(get_path_context(node_path, node_map))
+    
+    # each 768 x 768 px image costs 258 vision tokens
+    vision_tokens = vision_tokens_for_size(context_image.width, context_image.height)
+    # encoded once; the bytes go to Gemini, to disk and (as base64) to the client
+    entry = (context_image, vision_tokens, encode_image_bytes(context_image))
+    store_context_image(key, entry)
+    return entry
+
+
+# text sent around the context image; prompt text tokens are counted over header + trailer
+CONTEXT_PROMPT_HEADER = GeminiImageContextChat.CONTEXT_PROMPT_HEADER
+CONTEXT_PROMPT_TRAILER = GeminiImageContextChat.CONTEXT_PROMPT_TRAILER
+# only the user's message varies, so the template's own length is measured once
+CONTEXT_PROMPT_CHARS = len(CONTEXT_PROMPT_HEADER) + len(CONTEXT_PROMPT_TRAILER.format(""))
+
+
+async def generate_content(model, prompt_parts: list, stream: bool = False):
+    # the SDK's async client waits on the network without holding a worker thread
+    return await model.generate_content_async(prompt_parts, stream=stream)
+
+
+async def run_session_sweeper():
+    # requests only evict sessions older than the one they touch, so an idle server
+    # would otherwise keep every expired session (and its Gemini client) forever
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_SECONDS)
+        evict_idle_sessions(time.monotonic())
+
+
+async def send_message_with_context(chat: GeminiImageContextChat, node_path: List[str], node_map: Dict[str, NodePath], path_digests: Dict[str, bytes], context_text_chars: int, user_message: str, session_id: str = "default", node_id: str = None, background_tasks: Optional[BackgroundTasks] = None) -> Tuple[Any, Optional[Image.Image], Optional[bytes], dict]:
+    """
+    Build the prompt for a turn and start generating the reply.
     
+    node_path, node_map, path_digests and context_text_chars come from snapshot_turn_context.
+    Returns the streaming Gemini response (iterate it for text chunks) together with
+    the context image (None if Gemini is sent its bytes and the cache had dropped it),
+    its encoded bytes and the token accounting for the call.
+    With CLARITY_PERSIST_CONTEXT_IMAGES set, a debug copy of the image is also
+    written to disk, by background_tasks when one is given.
+    """
     context_image = None
+    context_image_bytes = None
     vision_tokens = 0
-    text_tokens = 0
-    text_equivalent_tokens = 0
     
-    if context_messages:
-       
-        context_image = image_storage.messages_to_image(context_messages)
-        
+    if node_path:
+        # rendering and encoding are CPU-bound, keep them off the event loop
+        context_image, vision_tokens, context_image_bytes = await asyncio.to_thread(
+            build_context_image, context_image_storage, path_digests, node_path, node_map,
+            CONTEXT_IMAGE_FORMAT not in GEMINI_IMAGE_FORMATS
+        )
         
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]  # Include milliseconds
-        if node_id:
-            image_filename = f"context_{session_id}_{node_id}_{timestamp}.png"
-        else:
-            image_filename = f"context_{session_id}_{timestamp}.png"
-        image_path = os.path.join(CONTEXT_IMAGES_DIR, image_filename)
-        context_image.save(image_path)
-        print(f"Context image saved: {image_path}")
         
-        # each 768 x 768 px image costs 258 vision tokens
-    
-        vision_tokens = chat.estimate_vision_tokens(context_image, verbose=True)
-        print(f"[Token Calculation] Image: {context_image.width}x{context_image.height}px = {vision_tokens} vision tokens")
+        if PERSIST_CONTEXT_IMAGES:
+            # wall-clock milliseconds, so names stay unique across restarts (monotonic time restarts at boot)
+            timestamp = time.time_ns() // 1_000_000
+            extension = CONTEXT_IMAGE_FORMAT.lower()
+            if node_id:
+                image_filename = f"context_{session_id}_{node_id}_{timestamp}.{extension}"
+            else:
+                image_filename = f"context_{session_id}_{timestamp}.{extension}"
+            image_path = os.path.join(CONTEXT_IMAGES_DIR, image_filename)
+            # the copy on disk reuses the bytes already encoded for the client
+            if background_tasks is not None:
+                background_tasks.add_task(write_image_file, image_path, context_image_bytes)
+            else:
+                await asyncio.to_thread(write_image_file, image_path, context_image_bytes)
         
         # calculate text equivalent: total characters in entire chat history (context + user message) / 4
         # this represents what it would cost to send all messages as text
-        context_text_chars = sum(len(msg['content']) for msg in context_messages)
         user_message_chars = len(user_message)
         total_text_chars = context_text_chars + user_message_chars
         text_equivalent_total = total_text_chars // 4
-        print(f"[Token Calculation] Text Equivalent: {total_text_chars} chars / 4 = {text_equivalent_total} tokens")
         
         
-        prompt_text = f"Here is our conversation history as an image:\nUser's new message: {user_message}\n\nPlease respond naturally based on the conversation history shown in the image."
+        # with lossless WebP, Gemini gets the bytes already encoded for the client; handed a PIL
+        # image, the SDK would encode it again (lossless WebP at its default effort) on the event loop
+        if CONTEXT_IMAGE_FORMAT in GEMINI_IMAGE_FORMATS:
+            prompt_image = {'mime_type': f"image/{CONTEXT_IMAGE_FORMAT.lower()}", 'data': context_image_bytes}
+        else:
+            prompt_image = context_image
+        
+        prompt_trailer = CONTEXT_PROMPT_TRAILER.format(user_message)
+        prompt_chars = CONTEXT_PROMPT_CHARS + user_message_chars
         prompt_parts = [
-            "Here is our conversation history as an image:",
-            context_image,
-            f"\nUser's new message: {user_message}\n\nPlease respond naturally based on the conversation history shown in the image."
+            CONTEXT_PROMPT_HEADER,
+            prompt_image,
+            prompt_trailer
         ]
     else:
-        context_image = None
-        vision_tokens = 0
         prompt_parts = [user_message]
-        prompt_text = user_message
+        prompt_chars = len(user_message)
         text_equivalent_total = len(user_message) // 4
     
     # calculate prompt text tokens for image method
     # counts only text prompts
-    text_tokens = chat.estimate_text_tokens(prompt_text)
-    print(f"[Token Calculation] Prompt text tokens: {text_tokens} tokens")
-    print(f"[Token Calculation] Total for this API call: {vision_tokens} vision + {text_tokens} text = {vision_tokens + text_tokens} tokens")
+    text_tokens = chat.estimate_text_tokens_for_chars(prompt_chars)
     
-    response = chat.model.generate_content(prompt_parts)
-    response_text = response.text
+    # with stream=True the SDK returns once the first chunk has arrived
+    response_stream = await generate_content(chat.model, prompt_parts, stream=True)
     
     # Calculate token savings: Text Equivalent - (Vision Tokens + Prompt Text Tokens)
     # Formula: Token Savings = Text Equivalent - (Vision Tokens + Prompt Text Tokens)
-    if context_messages:
+    if node_path:
         token_savings = text_equivalent_total - (vision_tokens + text_tokens)
-        print(f"[Token Calculation] Savings: {text_equivalent_total} - ({vision_tokens} + {text_tokens}) = {token_savings} tokens")
     else:
         token_savings = 0
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "[Token Calculation] vision=%d text=%d text_equivalent=%d savings=%d",
+            vision_tokens, text_tokens, text_equivalent_total, token_savings
+        )
     
-    return response_text, context_image, {
+    return response_stream, context_image, context_image_bytes, {
         'vision_tokens': vision_tokens,
         'text_tokens': text_tokens,
         'text_equivalent_tokens': text_equivalent_total,
@@ -179,41 +704,45 @@ def send_message_with_context(chat: GeminiImageContextChat, context_messages: Li
     }
 
 
-@app.post("/api/chat", response_model=MessageResponse)
-async def send_message(request: MessageRequest):
+@app.post("/api/chat")
+async def send_message(http_request: Request, background_tasks: BackgroundTasks):
+    request: MessageRequest = await decode_body(http_request, message_request_decoder)
     try:
         chat = get_or_create_session(request.session_id)
-        tree = request.tree
-        
-        node_path = []
-        if request.parent_node_id:
-            node_map = {node.node_id: node for node in tree.nodes}
-            current_id = request.parent_node_id
-            
-            path_to_root = []
-            while current_id:
-                if current_id not in node_map:
-                    break
-                path_to_root.append(current_id)
-                node = node_map[current_id]
-                current_id = node.parent_id
-            
-            node_path = list(reversed(path_to_root))
+        node_path, node_map, path_digests, context_text_chars = snapshot_turn_context(
+            request.session_id, request.tree, request.parent_node_id
+        )
         
-        context_messages = get_path_context(node_path, tree.nodes)
+        # random rather than the clock, so chats finishing in the same millisecond never share an ID
+        node_id = uuid.uuid4().hex
         
-        import time
-        node_id = str(int(time.time() * 1000))
+        start_session_warmup(request.session_id, chat)
         
-        response_text, context_image, token_data = send_message_with_context(
-            chat, context_messages, request.user_message, session_id=request.session_id, node_id=node_id
+        response_stream, context_image, context_image_bytes, token_data = await send_message_with_context(
+            chat, node_path, node_map, path_digests, context_text_chars, request.user_message, session_id=request.session_id, node_id=node_id,
+            background_tasks=background_tasks
         )
-        
-        context_image_base64 = None
-        if context_image:
-            buffered = BytesIO()
-            context_image.save(buffered, format="PNG")
-            context_image_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"{str(e)}\n{traceback.format_exc()}")
+    
+    async def events():
+        """
+        Server-sent events: one {"delta": ...} per text chunk, then a final
+        {"done": true, ...MessageResponse fields}. The node is only stored once
+        the whole reply has arrived.
+        """
+        chunks = []
+        try:
+            async for chunk in response_stream:
+                chunks.append(chunk.text)
+                yield sse_event({'delta': chunk.text})
+        except Exception as e:
+            yield sse_event({'error': str(e)})
+            return
+        response_text = "".join(chunks)
         
         call_stats = {
             'node_id': node_id,
@@ -223,79 +752,213 @@ async def send_message(request: MessageRequest):
             'token_savings': token_data['token_savings'],
             'timestamp': time.time()
         }
-        if request.session_id not in token_stats:
-            token_stats[request.session_id] = []
-        token_stats[request.session_id].append(call_stats)
+        record_call_stats(request.session_id, call_stats)
+        
+        add_tree_node(request.session_id, NodePath(
+            node_id=node_id,
+            parent_id=request.parent_node_id,
+            prompt=request.user_message,
+            response=response_text,
+            timestamp=datetime.now().isoformat()
+        ))
         
-        return MessageResponse(
+        # base64 only for clients that display the image
+        if request.include_context_image and context_image_bytes is not None:
+            message_image = base64.b64encode(context_image_bytes).decode('ascii')
+        else:
+            message_image = None
+        message_response = MessageResponse(
             node_id=node_id,
             response=response_text,
             vision_tokens=token_data['vision_tokens'],
             text_tokens=token_data['text_tokens'],
             text_equivalent_tokens=token_data['text_equivalent_tokens'],
             token_savings=token_data['token_savings'],
-            context_image_base64=context_image_base64
+            context_image_base64=message_image,
+            context_image_format=CONTEXT_IMAGE_FORMAT.lower() if message_image else None
         )
+        done = {'done': True, **msgspec.structs.asdict(message_response)}
+        yield sse_event(done)
     
-    except Exception as e:
-        import traceback
-        raise HTTPException(status_code=500, detail=f"{str(e)}\n{traceback.format_exc()}")
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.get("/api/tree/{session_id}")
+async def get_tree(session_id: str):
+    """
+    Get the server-side conversation tree for a session.
+    
+    Lets the client resync after a reload without keeping its own copy authoritative.
+    """
+    node_map = session_node_index.get(session_id, {})
+    nodes = [node_map[node_id] for node_id in session_node_order.get(session_id, [])]
+    tree = ConversationTree(session_id=session_id, nodes=nodes)
+    return MsgspecJSONResponse(tree)
+
+
+class TreeNodeRequest(msgspec.Struct):
+    session_id: str
+    node: NodePath
+
+
+tree_node_request_decoder = msgspec.json.Decoder(TreeNodeRequest)
+
+
+@app.post("/api/tree/node")
+async def append_tree_node(http_request: Request):
+    """
+    Append one node to the server-side tree without generating a reply.
+
+    Only the new node is sent and decoded, so clients adding nodes of their own
+    (e.g. when restoring an exported tree) never resend the whole tree. No reply is
+    generated, so only the session's tree is set up, not a Gemini client.
+    """
+    request: TreeNodeRequest = await decode_body(http_request, tree_node_request_decoder)
+    session_id = request.session_id
+    node = request.node
+    get_or_create_session_tree(session_id)
+
+    node_map = session_node_index[session_id]
+    if node.node_id in node_map:
+        raise HTTPException(status_code=409, detail="Node already exists")
+    if node.parent_id and node.parent_id not in node_map:
+        raise HTTPException(status_code=409, detail="Unknown parent node, resend the tree with /api/chat")
+    add_tree_node(session_id, node)
+    return MsgspecJSONResponse(node)
+
+
+@app.get("/api/context_image/{session_id}/{node_id}")
+async def get_context_image(session_id: str, node_id: str, request: Request):
+    """
+    Get the context image sent to Gemini when replying to node_id (its path from the root).
+    
+    Served as raw bytes, so chat replies don't have to carry it as base64. The configured
+    codec is served from the cache; clients whose Accept header rules it out get the
+    image re-encoded in one they list.
+    """
+    if node_id not in session_parent_of.get(session_id, {}):
+        raise HTTPException(status_code=404, detail="Unknown session or node")
+    image_format = negotiate_image_format(request.headers.get("accept"))
+    node_path, node_map, path_digests, _ = snapshot_turn_context(session_id, None, node_id)
+    context_image, _, context_image_bytes = await asyncio.to_thread(
+        build_context_image, context_image_storage, path_digests, node_path, node_map,
+        image_format != CONTEXT_IMAGE_FORMAT
+    )
+    if image_format != CONTEXT_IMAGE_FORMAT:
+        context_image_bytes = await asyncio.to_thread(encode_image_bytes, context_image, image_format)
+    return Response(content=context_image_bytes, media_type=f"image/{image_format.lower()}")
 
 
-class StatsRequest(BaseModel):
+def tree_messages(nodes: List[NodePath]) -> List[Dict[str, str]]:
+    messages = []
+    for node in nodes:
+        if node.prompt:
+            messages.append({'role': 'user', 'content': node.prompt})
+        if node.response:
+            messages.append({'role': 'model', 'content': node.response})
+    return messages
+
+
+def render_messages_image(messages: List[Dict[str, str]]) -> Image.Image:
+    # runs in a render_pool process, which has its own copy of the shared renderer
+    return context_image_storage.messages_to_image(messages)
+
+
+async def render_tree_image(image_storage: ImageContextStorage, session_id: str, all_messages: List[Dict[str, str]]) -> Image.Image:
+    """
+    Render every message in the tree, reusing the session's previous render when the
+    tree has only grown since then (the client polls stats after each turn).
+    
+    The previous render is matched on the messages themselves rather than node IDs,
+    since the client rewrites nodes under the same ID (e.g. a temp_ reply).
+    
+    Extending the previous render is cheap and done on a worker thread; full renders
+    go to the render process pool.
+    """
+    cached = session_tree_image.get(session_id)
+    
+    context_image = None
+    if cached is not None:
+        rendered_messages, rendered_image = cached
+        if rendered_messages and all_messages[:len(rendered_messages)] == rendered_messages:
+            new_messages = all_messages[len(rendered_messages):]
+            context_image = await asyncio.to_thread(image_storage.append_messages_to_image, rendered_image, new_messages)
+            logger.debug("[Stats Calculation] Extended cached tree image with %d messages", len(new_messages))
+    if context_image is None:
+        if render_pool is not None:
+            context_image = await asyncio.get_running_loop().run_in_executor(render_pool, render_messages_image, all_messages)
+        else:
+            context_image = await asyncio.to_thread(image_storage.messages_to_image, all_messages)
+    
+    session_tree_image[session_id] = (all_messages, context_image)
+    return context_image
+
+
+class StatsRequest(msgspec.Struct):
     session_id: str
     tree: ConversationTree
     active_node_path: Optional[List[str]] = None  # List of node IDs from root to active node
 
 
-@app.post("/api/stats/calculate", response_model=TokenStatsResponse)
-async def calculate_token_stats(request: StatsRequest):
+stats_request_decoder = msgspec.json.Decoder(StatsRequest)
+
+
+@app.post("/api/stats/calculate")
+async def calculate_token_stats(http_request: Request, background_tasks: BackgroundTasks, render: bool = False):
     """
     Calculate token statistics based on the ENTIRE conversation tree.
     
-    This creates ONE image of ALL messages from ALL branches and calculates:
+    This sizes ONE image of ALL messages from ALL branches and calculates:
     - Vision tokens: Based on the single comprehensive image (ceil(height/768) * 258)
     - Text tokens: Based on all messages in the entire tree (total chars / 4)
     - Token savings: Text equivalent - Vision tokens
     
     Note: Order of messages doesn't matter - all messages from all branches are included.
+    
+    The image is only actually drawn with ?render=true (or when images are persisted);
+    otherwise its height is worked out from the wrapped line counts.
     """
+    request: StatsRequest = await decode_body(http_request, stats_request_decoder)
     session_id = request.session_id
     tree = request.tree
     
     
-    all_messages = []
-    for node in tree.nodes:
-        if node.prompt:
-            all_messages.append({'role': 'user', 'content': node.prompt})
-        if node.response:
-            all_messages.append({'role': 'model', 'content': node.response})
+    all_messages = tree_messages(tree.nodes)
     
-    # get or create chat session for token estimation
-    chat = get_or_create_session(session_id)
-    image_storage = ImageContextStorage()
+    # get or create the chat session the stats are kept under; the posted tree is only
+    # measured, the chat index is left to /api/chat (it may hold unfinished temp_ nodes)
+    get_or_create_session(session_id)
     
     # calculate tokens based on the entire conversation tree
     if all_messages:
-        # create an image of the entire conversation tree
-        context_image = image_storage.messages_to_image(all_messages)
-        
-        # save the context image for this stats calculation
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]
-        image_filename = f"stats_context_{session_id}_{timestamp}.png"
-        image_path = os.path.join(CONTEXT_IMAGES_DIR, image_filename)
-        context_image.save(image_path)
-        print(f"[Stats Calculation] Entire conversation image saved: {image_path}")
+        if render or PERSIST_CONTEXT_IMAGES:
+            # create an image of the entire conversation tree
+            context_image = await render_tree_image(context_image_storage, session_id, all_messages)
+            image_height = context_image.height
+            
+            # save the context image for this stats calculation once the response is sent
+            if PERSIST_CONTEXT_IMAGES:
+                timestamp = time.time_ns() // 1_000_000
+                image_filename = f"stats_context_{session_id}_{timestamp}.jpg"
+                image_path = os.path.join(CONTEXT_IMAGES_DIR, image_filename)
+                background_tasks.add_task(save_stats_image, context_image, image_path)
+        else:
+            # vision tokens only depend on the height, which the line counts give without drawing;
+            # wrapped lines are memoized by text, so unchanged messages are not wrapped again
+            image_height = await asyncio.to_thread(context_image_storage.compute_height, all_messages)
         
        
-        vision_tokens = chat.estimate_vision_tokens(context_image, verbose=True)
-        print(f"[Stats Calculation] Entire conversation image: {context_image.width}x{context_image.height}px = {vision_tokens} vision tokens")
+        image_width = context_image_storage.width
+        vision_tokens = vision_tokens_for_size(image_width, image_height)
         
         # calculate text equivalent: total characters in entire conversation / 4
-        total_text_chars = sum(len(msg['content']) for msg in all_messages)
+        total_text_chars = sum(len(node.prompt) + len(node.response) for node in tree.nodes)
         text_equivalent_total = total_text_chars // 4
-        print(f"[Stats Calculation] Entire conversation text: {total_text_chars} chars / 4 = {text_equivalent_total} tokens")
-        print(f"[Stats Calculation] Total nodes in tree: {len(tree.nodes)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "[Stats Calculation] %d nodes: %dx%dpx = %d vision tokens, %d chars = %d text tokens",
+                len(tree.nodes), image_width, image_height, vision_tokens, total_text_chars, text_equivalent_total
+            )
         
  
         prompt_text_tokens = 0
@@ -314,22 +977,66 @@ async def calculate_token_stats(request: StatsRequest):
         token_savings = 0
         cost_savings = 0.0
         api_calls_count = 0
-        context_image = None
     
-    return TokenStatsResponse(
+    # msgspec structs are encoded directly, without a response_model validation pass
+    return MsgspecJSONResponse(TokenStatsResponse(
         session_id=session_id,
         total_api_calls=api_calls_count,
         total_vision_tokens=vision_tokens,
         total_text_tokens=prompt_text_tokens,
         total_text_equivalent_tokens=text_equivalent_total,
         total_token_savings=token_savings,
-        average_savings_per_call=token_savings / api_calls_count if api_calls_count > 0 else 0,
+        average_savings_per_call=token_savings / api_calls_count if api_calls_count > 0 else 0.0,
         cost_savings=cost_savings,
         calls=[]
-    )
+    ))
+
+
+class NodeTokenStats(msgspec.Struct):
+    node_id: str
+    prompt_tokens: int
+    response_tokens: int
+    text_tokens: int
+
+
+class PerNodeStatsResponse(msgspec.Struct):
+    session_id: str
+    nodes: List[NodeTokenStats]
+
+
+@app.post("/api/stats/per_node")
+async def calculate_per_node_stats(http_request: Request):
+    """
+    Text token estimates for every node in the tree.
+
+    All prompts and responses go through one text_tokens_for_texts call rather
+    than one estimate per node. The estimates are plain arithmetic, so no chat
+    session (or Gemini client) is created for them.
+    """
+    request: StatsRequest = await decode_body(http_request, stats_request_decoder)
+    session_id = request.session_id
+    nodes = request.tree.nodes
+
+    texts = [node.prompt for node in nodes] + [node.response for node in nodes]
+    token_counts = text_tokens_for_texts(texts)
+    prompt_tokens = token_counts[:len(nodes)]
+    response_tokens = token_counts[len(nodes):]
+
+    return MsgspecJSONResponse(PerNodeStatsResponse(
+        session_id=session_id,
+        nodes=[
+            NodeTokenStats(
+                node_id=node.node_id,
+                prompt_tokens=prompt,
+                response_tokens=response,
+                text_tokens=prompt + response,
+            )
+            for node, prompt, response in zip(nodes, prompt_tokens, response_tokens)
+        ]
+    ))
 
 
-@app.get("/api/stats/{session_id}", response_model=TokenStatsResponse)
+@app.get("/api/stats/{session_id}")
 async def get_token_stats(session_id: str):
     """
     Get token statistics for a session (legacy endpoint - sums up individual call stats).
@@ -339,84 +1046,82 @@ async def get_token_stats(session_id: str):
     with the active branch path for accurate calculations based on the current context.
     """
     if session_id not in token_stats:
-        return TokenStatsResponse(
+        return MsgspecJSONResponse(TokenStatsResponse(
             session_id=session_id,
             total_api_calls=0,
             total_vision_tokens=0,
             total_text_tokens=0,
             total_text_equivalent_tokens=0,
             total_token_savings=0,
-            average_savings_per_call=0,
+            average_savings_per_call=0.0,
             cost_savings=0.0,
             calls=[]
-        )
+        ))
     
-    # sum up tokens from individual API calls
+    # totals are kept up to date as calls are recorded
     stats = token_stats[session_id]
-    total_vision = sum(s['vision_tokens'] for s in stats)
-    total_text = sum(s['text_tokens'] for s in stats)
-    total_text_equiv = sum(s['text_equivalent_tokens'] for s in stats)
-    total_savings = sum(s['token_savings'] for s in stats)
-    avg_savings = total_savings / len(stats) if stats else 0
+    call_count = len(stats['node_ids'])
+    total_savings = stats['total_savings']
+    avg_savings = total_savings / call_count if call_count else 0.0
     
    # looks at cost savings
     cost_savings = (total_savings / 1_000_000) * 0.30
     
-    return TokenStatsResponse(
+    return MsgspecJSONResponse(TokenStatsResponse(
         session_id=session_id,
-        total_api_calls=len(stats),
-        total_vision_tokens=total_vision,
-        total_text_tokens=total_text,
-        total_text_equivalent_tokens=total_text_equiv,
+        total_api_calls=call_count,
+        total_vision_tokens=stats['total_vision'],
+        total_text_tokens=stats['total_text'],
+        total_text_equivalent_tokens=stats['total_text_equiv'],
         total_token_savings=total_savings,
         average_savings_per_call=avg_savings,
         cost_savings=cost_savings,
-        calls=stats
-    )
+        calls=call_stats_log(stats)
+    ))
 
 
 @app.delete("/api/session/{session_id}")
 async def delete_session(session_id: str):
-    if session_id in chat_sessions:
-        del chat_sessions[session_id]
-    if session_id in token_stats:
-        del token_stats[session_id]
+    drop_session(session_id)
     return {"message": f"Session {session_id} deleted"}
 
 
+class TreeExport(msgspec.Struct):
+    session_id: str
+    exported_at: str
+    total_nodes: int
+    nodes: List[NodePath]
+
+
+def encode_tree_export(export: TreeExport) -> bytes:
+    # msgspec writes UTF-8 as is, like json.dumps(ensure_ascii=False)
+    return msgspec.json.format(json_encoder.encode(export), indent=2)
+
+
 @app.post("/api/download/json")
-async def download_json(request: StatsRequest):
+async def download_json(http_request: Request):
     """
     Download the entire conversation tree as JSON.
     
     Returns a JSON file containing all nodes from the conversation tree.
     """
+    request: StatsRequest = await decode_body(http_request, stats_request_decoder)
     session_id = request.session_id
     tree = request.tree
     
-    json_data = {
-        "session_id": session_id,
-        "exported_at": datetime.now().isoformat(),
-        "total_nodes": len(tree.nodes),
-        "nodes": [
-            {
-                "node_id": node.node_id,
-                "parent_id": node.parent_id,
-                "prompt": node.prompt,
-                "response": node.response,
-                "timestamp": node.timestamp,
-            }
-            for node in tree.nodes
-        ]
-    }
+    export = TreeExport(
+        session_id=session_id,
+        exported_at=datetime.now().isoformat(),
+        total_nodes=len(tree.nodes),
+        nodes=tree.nodes,
+    )
 
-    # make a downloadable file
-    
-    json_string = json.dumps(json_data, indent=2, ensure_ascii=False)
+    # make a downloadable file; the nodes are encoded straight from the decoded structs
+    json_bytes = await asyncio.to_thread(encode_tree_export, export)
     
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     return Response(
-        content=json_string,
+        content=json_bytes,
         media_type="application/json",
         headers={
             "Content-Disposition": f'attachment; filename="conversation_tree_{session_id}_{timestamp}.json"'
@@ -424,97 +1129,115 @@ async def download_json(request: StatsRequest):
     )
 
 
-@app.post("/api/download/pdf")
-async def download_pdf(request: StatsRequest):
-    """
-    Download the entire conversation tree as PDF.
-    
-    Creates a PDF containing all messages from the conversation tree.
-    """
-    try:
-        from reportlab.lib.pagesizes import letter, A4
-        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-        from reportlab.lib.units import inch
-        from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak
-        from reportlab.lib.enums import TA_LEFT
-        from reportlab.pdfbase import pdfmetrics
-        from reportlab.pdfbase.ttfonts import TTFont
-    except ImportError:
-        raise HTTPException(
-            status_code=500,
-            detail="reportlab library is required for PDF generation. Install it with: pip install reportlab"
-        )
-    
-    session_id = request.session_id
-    tree = request.tree
+# reportlab paragraphs are mini-markup, so message text has its markup characters escaped
+PDF_ESCAPES = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+
+# reportlab is optional; its paragraph styles are built once here rather than per export
+try:
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.lib.units import inch
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+    from reportlab.lib.enums import TA_LEFT
     
+    pdf_sample_styles = getSampleStyleSheet()
+    PDF_STYLES = {
+        'normal': pdf_sample_styles['Normal'],
+        'heading': pdf_sample_styles['Heading2'],
+        'italic': pdf_sample_styles['Italic'],
+        'title': ParagraphStyle(
+            'CustomTitle',
+            parent=pdf_sample_styles['Heading1'],
+            fontSize=16,
+            textColor='#000000',
+            spaceAfter=12,
+            alignment=TA_LEFT,
+        ),
+        'user': ParagraphStyle(
+            'UserStyle',
+            parent=pdf_sample_styles['Normal'],
+            fontSize=11,
+            textColor='#007aff',
+            leftIndent=0,
+            spaceAfter=6,
+            fontName='Helvetica-Bold',
+        ),
+        'model': ParagraphStyle(
+            'ModelStyle',
+            parent=pdf_sample_styles['Normal'],
+            fontSize=11,
+            textColor='#000000',
+            leftIndent=20,
+            spaceAfter=12,
+        ),
+    }
+except ImportError:
+    PDF_STYLES = None
+
+
+def build_tree_pdf(session_id: str, nodes: List[NodePath]) -> bytes:
+    """Lay out the conversation tree as a PDF; CPU-bound, run it on a worker thread."""
+    styles = PDF_STYLES
     buffer = BytesIO()
     
     # create the PDF file
     doc = SimpleDocTemplate(buffer, pagesize=letter, topMargin=0.5*inch, bottomMargin=0.5*inch)
     story = []
     
-    styles = getSampleStyleSheet()
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=16,
-        textColor='#000000',
-        spaceAfter=12,
-        alignment=TA_LEFT,
-    )
-    user_style = ParagraphStyle(
-        'UserStyle',
-        parent=styles['Normal'],
-        fontSize=11,
-        textColor='#007aff',
-        leftIndent=0,
-        spaceAfter=6,
-        fontName='Helvetica-Bold',
-    )
-    model_style = ParagraphStyle(
-        'ModelStyle',
-        parent=styles['Normal'],
-        fontSize=11,
-        textColor='#000000',
-        leftIndent=20,
-        spaceAfter=12,
-    )
-    
-    story.append(Paragraph("Conversation Tree Export", title_style))
-    story.append(Paragraph(f"Session: {session_id}", styles['Normal']))
-    story.append(Paragraph(f"Exported: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", styles['Normal']))
-    story.append(Paragraph(f"Total Nodes: {len(tree.nodes)}", styles['Normal']))
+    story.append(Paragraph("Conversation Tree Export", styles['title']))
+    story.append(Paragraph(f"Session: {session_id}", styles['normal']))
+    story.append(Paragraph(f"Exported: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", styles['normal']))
+    story.append(Paragraph(f"Total Nodes: {len(nodes)}", styles['normal']))
     story.append(Spacer(1, 0.2*inch))
-    story.append(Paragraph("<hr/>", styles['Normal']))
+    story.append(Paragraph("<hr/>", styles['normal']))
     story.append(Spacer(1, 0.2*inch))
     
     # handling an empty tree
-    if not tree.nodes:
-        story.append(Paragraph("No conversation nodes found.", styles['Normal']))
+    if not nodes:
+        story.append(Paragraph("No conversation nodes found.", styles['normal']))
     else:
-        for i, node in enumerate(tree.nodes):
-            story.append(Paragraph(f"<b>Node {i+1}</b> (ID: {node.node_id})", styles['Heading2']))
+        for i, node in enumerate(nodes):
+            story.append(Paragraph(f"<b>Node {i+1}</b> (ID: {node.node_id})", styles['heading']))
             if node.prompt:
-                story.append(Paragraph("<b>USER:</b>", user_style))
-                prompt_text = node.prompt.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-                story.append(Paragraph(prompt_text, model_style))
+                story.append(Paragraph("<b>USER:</b>", styles['user']))
+                prompt_text = node.prompt.translate(PDF_ESCAPES)
+                story.append(Paragraph(prompt_text, styles['model']))
             if node.response:
-                story.append(Paragraph("<b>MODEL:</b>", user_style))
-                response_text = node.response.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-                story.append(Paragraph(response_text, model_style))
+                story.append(Paragraph("<b>MODEL:</b>", styles['user']))
+                response_text = node.response.translate(PDF_ESCAPES)
+                story.append(Paragraph(response_text, styles['model']))
             if node.timestamp:
-                story.append(Paragraph(f"<i>Timestamp: {node.timestamp}</i>", styles['Italic']))
-            if i < len(tree.nodes) - 1:
+                story.append(Paragraph(f"<i>Timestamp: {node.timestamp}</i>", styles['italic']))
+            if i < len(nodes) - 1:
                 story.append(Spacer(1, 0.3*inch))
-                story.append(Paragraph("<hr/>", styles['Normal']))
+                story.append(Paragraph("<hr/>", styles['normal']))
                 story.append(Spacer(1, 0.2*inch))
     
     doc.build(story)
     
-    buffer.seek(0)
     pdf_bytes = buffer.getvalue()
     buffer.close()
+    return pdf_bytes
+
+
+@app.post("/api/download/pdf")
+async def download_pdf(http_request: Request):
+    """
+    Download the entire conversation tree as PDF.
+    
+    Creates a PDF containing all messages from the conversation tree.
+    """
+    request: StatsRequest = await decode_body(http_request, stats_request_decoder)
+    if PDF_STYLES is None:
+        raise HTTPException(
+            status_code=500,
+            detail="reportlab library is required for PDF generation. Install it with: pip install reportlab"
+        )
+    
+    session_id = request.session_id
+    
+    # paragraph layout takes a while on big trees, keep it off the event loop
+    pdf_bytes = await asyncio.to_thread(build_tree_pdf, session_id, request.tree.nodes)
     
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     return Response(
@@ -19,7 +19,7 @@ def example_conversation():
     
     
     print("Initializing chat system...")
-    chat = GeminiImageContextChat(api_key)
+    chat = GeminiImageContextChat(api_key, verbose=True)
     
     # sample conversation prompts
     messages = [
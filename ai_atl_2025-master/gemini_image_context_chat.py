@@ -5,14 +5,188 @@ Vision tokens are typically cheaper than text tokens in many LLM APIs.
 """
 
 import os
+import sys
 import base64
+import threading
 from io import BytesIO
+from bisect import bisect_right
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import accumulate
 from PIL import Image, ImageDraw, ImageFont
 import google.generativeai as genai
-from typing import List, Dict, Tuple
+from typing import List, Dict, Optional, Tuple
 from datetime import datetime
 
 
+@lru_cache(maxsize=1024)
+def vision_tokens_for_size(width: int, height: int) -> int:
+    """
+    Vision tokens for an image of the given size, memoized by dimensions.
+    
+    Sibling branches and repeated stats calls produce images of identical size,
+    so the token count only has to be worked out once per size.
+    
+    Args:
+        width: Image width in pixels (expected to be 768)
+        height: Image height in pixels
+        
+    Returns:
+        ceil(height / 768) * 258
+    """
+    height_units = -(-height // 768)  # Ceiling division
+    return height_units * 258
+
+
+def text_tokens_for_texts(texts: List[str]) -> List[int]:
+    """
+    Estimate text tokens for many strings, without needing a chat session.
+    
+    Args:
+        texts: Texts to estimate tokens for
+    
+    Returns:
+        Estimated number of text tokens for each text (~4 chars per token), in the same order
+    """
+    return [char_count // 4 for char_count in map(len, texts)]
+
+
+# Fonts tried in order for rendering; the first one present is picked once at import
+FONT_CANDIDATES = (
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/System/Library/Fonts/Helvetica.ttc",
+)
+FONT_PATH = next((path for path in FONT_CANDIDATES if os.path.exists(path)), None)
+
+
+@lru_cache(maxsize=16)
+def load_font(font_size: int):
+    """
+    Load the rendering font at a size, once per process.
+    
+    Every ImageContextStorage gets the same font object for a size, so the TrueType
+    file is opened once and the wrap caches below are shared between instances.
+    
+    Args:
+        font_size: Font size to load
+        
+    Returns:
+        PIL ImageFont object
+    """
+    if FONT_PATH is None:
+        return ImageFont.load_default()
+    return ImageFont.truetype(FONT_PATH, font_size)
+
+
+@lru_cache(maxsize=65536)
+def word_length(font: ImageFont.FreeTypeFont, word: str) -> float:
+    """
+    Advance width of a word in a font, memoized; words repeat a lot across messages.
+    
+    Args:
+        font: Font to measure with
+        word: Word (or a single space) to measure
+        
+    Returns:
+        Advance width in pixels
+    """
+    return font.getlength(word)
+
+
+# wrapped lines memoized by (text, max_width, font), least recently used first; capped at
+# WRAP_CACHE_CHARS characters of text rather than an entry count, since a message can be
+# anything from a word to a whole document (each entry holds its text as key and as lines)
+WRAP_CACHE_CHARS = 8 * 1024 * 1024
+wrap_cache: "OrderedDict[Tuple[str, int, ImageFont.FreeTypeFont], Tuple[str, ...]]" = OrderedDict()
+wrap_cache_chars = 0
+wrap_cache_lock = threading.Lock()  # the API server renders on worker threads
+
+
+def wrap_text_lines(text: str, max_width: int, font: ImageFont.FreeTypeFont) -> Tuple[str, ...]:
+    """
+    Greedily wrap text into lines no wider than max_width, memoized per text and font.
+    
+    Conversations are re-rendered every turn with all of their earlier messages,
+    so each message would otherwise be re-measured word by word on every render.
+    
+    Args:
+        text: Text to wrap
+        max_width: Maximum width in pixels
+        font: Font to use for measuring text width
+        
+    Returns:
+        Tuple of wrapped text lines
+    """
+    global wrap_cache_chars
+    key = (text, max_width, font)
+    with wrap_cache_lock:
+        lines = wrap_cache.get(key)
+        if lines is not None:
+            wrap_cache.move_to_end(key)
+            return lines
+    
+    lines = measure_wrapped_lines(text, max_width, font)
+    with wrap_cache_lock:
+        if key not in wrap_cache:
+            wrap_cache[key] = lines
+            wrap_cache_chars += len(text)
+        # the newest entry always stays, even on its own over budget
+        while wrap_cache_chars > WRAP_CACHE_CHARS and len(wrap_cache) > 1:
+            (evicted_text, _, _), _ = wrap_cache.popitem(last=False)
+            wrap_cache_chars -= len(evicted_text)
+    return lines
+
+
+def measure_wrapped_lines(text: str, max_width: int, font: ImageFont.FreeTypeFont) -> Tuple[str, ...]:
+    """
+    Greedily wrap text into lines no wider than max_width (wrap_text_lines memoizes this).
+    
+    Break points are estimated from running sums of memoized word widths and then
+    settled with getbbox on the joined line, which usually takes two measurements
+    per line instead of one per word. A line's bbox only grows as words are added,
+    so the lines are the same as adding one word at a time until one doesn't fit.
+    
+    Args:
+        text: Text to wrap
+        max_width: Maximum width in pixels
+        font: Font to use for measuring text width
+        
+    Returns:
+        Tuple of wrapped text lines
+    """
+    words = text.split()
+    space = word_length(font, ' ')
+    # ends[j]: estimated width of words[0..j] joined by spaces, plus one trailing space
+    ends = list(accumulate(word_length(font, word) + space for word in words))
+    
+    def fits(start: int, end: int) -> bool:
+        bbox = font.getbbox(' '.join(words[start:end]))
+        return bbox[2] - bbox[0] <= max_width
+    
+    lines = []
+    start = 0
+    while start < len(words):
+        # estimate: the words whose running width stays within max_width
+        line_start = ends[start - 1] if start else 0
+        end = max(bisect_right(ends, line_start + max_width + space, lo=start), start + 1)
+        
+        # the estimate ignores kerning and side bearings, so settle the break exactly;
+        # a line always keeps its first word, even one wider than max_width
+        if fits(start, end):
+            while end < len(words) and fits(start, end + 1):
+                end += 1
+        else:
+            while end > start + 1:
+                end -= 1
+                if fits(start, end):
+                    break
+        
+        lines.append(' '.join(words[start:end]))
+        start = end
+    
+    return tuple(lines)
+
+
 class ImageContextStorage:
     """Handles conversion of text context to images for efficient storage."""
     
@@ -37,11 +211,10 @@ class ImageContextStorage:
         self.font_size = font_size
         self.line_spacing = line_spacing
         self.padding = padding
-        self.font_cache = {}  # Cache fonts by size
     
     def _get_font(self, font_size: int):
         """
-        Get a font of the specified size, using cache if available.
+        Get a font of the specified size, shared by all storage instances.
         
         Args:
             font_size: Font size to get
@@ -49,25 +222,15 @@ class ImageContextStorage:
         Returns:
             PIL ImageFont object
         """
-        if font_size in self.font_cache:
-            return self.font_cache[font_size]
-        
-        try:
-            font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 
-                                     font_size)
-        except:
-            try:
-                font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", font_size)
-            except:
-                font = ImageFont.load_default()
-        
-        self.font_cache[font_size] = font
-        return font
+        return load_font(font_size)
     
     def wrap_text(self, text: str, max_width: int, font: ImageFont.FreeTypeFont) -> List[str]:
         """
         Wrap text to fit within a specified width.
         
+        Results are memoized, so a message is only measured the first time it is
+        rendered; later renders of a growing conversation reuse its lines.
+        
         Args:
             text: Text to wrap
             max_width: Maximum width in pixels
@@ -76,26 +239,50 @@ class ImageContextStorage:
         Returns:
             List of wrapped text lines
         """
-        words = text.split()
-        lines = []
-        current_line = []
+        return list(wrap_text_lines(text, max_width, font))
+    
+    def message_line_count(self, message: Dict[str, str]) -> int:
+        """
+        Count the lines one message takes up in messages_to_image.
         
-        for word in words:
-            test_line = ' '.join(current_line + [word])
-            bbox = font.getbbox(test_line)
-            width = bbox[2] - bbox[0]
+        Args:
+            message: Message dictionary with 'role' and 'content' keys
             
-            if width <= max_width:
-                current_line.append(word)
-            else:
-                if current_line:
-                    lines.append(' '.join(current_line))
-                current_line = [word]
+        Returns:
+            Number of lines: the role header plus the wrapped content
+        """
+        max_text_width = self.width - (2 * self.padding)
+        font = self._get_font(self.font_size)
+        return 1 + len(self.wrap_text(message['content'], max_text_width, font))
+    
+    def height_for_line_count(self, line_count: int) -> int:
+        """
+        Get the image height for a number of rendered lines, separators included.
+        
+        Args:
+            line_count: Total number of lines in the image
+            
+        Returns:
+            Image height in pixels, including the top and bottom padding
+        """
+        line_height = self.font_size + self.line_spacing
+        return (line_count * line_height) + (2 * self.padding)
+    
+    def compute_height(self, messages: List[Dict[str, str]]) -> int:
+        """
+        Compute the height messages_to_image would produce without drawing anything.
         
-        if current_line:
-            lines.append(' '.join(current_line))
+        Vision tokens only depend on the image height, so callers that just need
+        the token count can skip rasterizing the text altogether.
         
-        return lines
+        Args:
+            messages: List of message dictionaries with 'role' and 'content' keys
+            
+        Returns:
+            Image height in pixels
+        """
+        separators = max(len(messages) - 1, 0)
+        return self.height_for_line_count(sum(map(self.message_line_count, messages)) + separators)
     
     def messages_to_image(self, messages: List[Dict[str, str]]) -> Image.Image:
         """
@@ -140,18 +327,75 @@ class ImageContextStorage:
         draw = ImageDraw.Draw(image)
         
         # Draw text
-        y_position = self.padding
-        for line in all_lines:
-            if line.endswith(':'):  # Role headers (e.g., "USER:" or "MODEL:")
-                draw.text((self.padding, y_position), line, 
-                         fill='#2563eb', font=font)
-            else:
-                draw.text((self.padding, y_position), line, 
-                         fill='black', font=font)
-            y_position += line_height
+        self._draw_lines(draw, all_lines, self.padding, font)
         
         return image
-    
+
+    def _draw_lines(self, draw: ImageDraw.ImageDraw, lines: List[str], y_position: int,
+                    font: ImageFont.FreeTypeFont):
+        """
+        Draw lines one below the other, starting at y_position.
+        
+        Blank separator lines are skipped instead of being handed to FreeType,
+        since they render nothing.
+        
+        Args:
+            draw: Draw context of the target image
+            lines: Lines to draw, role headers end with ':'
+            y_position: Top of the first line
+            font: Font to draw with
+        """
+        line_height = self.font_size + self.line_spacing
+        x_position = self.padding
+        text = draw.text
+        for line in lines:
+            if line:
+                # Role headers (e.g., "USER:" or "MODEL:")
+                fill = '#2563eb' if line.endswith(':') else 'black'
+                text((x_position, y_position), line, fill=fill, font=font)
+            y_position += line_height
+
+    def append_messages_to_image(self, image: Image.Image,
+                                 messages: List[Dict[str, str]]) -> Image.Image:
+        """
+        Extend an image produced by messages_to_image with more messages.
+
+        The result is pixel-identical to rendering the combined message list from
+        scratch, but only the new messages are wrapped and drawn.
+
+        Args:
+            image: Image previously returned by messages_to_image (not modified)
+            messages: Messages to append below the existing content
+
+        Returns:
+            New PIL Image containing the original conversation plus the new messages
+        """
+        if not messages:
+            return image
+
+        max_text_width = self.width - (2 * self.padding)
+        font = self._get_font(self.font_size)
+        line_height = self.font_size + self.line_spacing
+
+        # Separator between the existing last message and the first new one
+        new_lines = [""]
+        for i, msg in enumerate(messages):
+            new_lines.append(f"{msg['role'].upper()}:")
+            new_lines.extend(self.wrap_text(msg['content'], max_text_width, font))
+            if i < len(messages) - 1:
+                new_lines.append("")
+
+        # Only the new rows are drawn, on a strip that is pasted below the untouched
+        # original; its first line sits where the old bottom padding began
+        strip = Image.new('RGB', (self.width, len(new_lines) * line_height), color='white')
+        self._draw_lines(ImageDraw.Draw(strip), new_lines, -self.padding, font)
+
+        # No background fill needed, the two pastes cover every pixel
+        combined = Image.new('RGB', (self.width, image.height + strip.height))
+        combined.paste(image, (0, 0))
+        combined.paste(strip, (0, image.height))
+        return combined
+
     def image_to_base64(self, image: Image.Image) -> str:
         """
         Convert PIL Image to base64 string.
@@ -163,33 +407,50 @@ class ImageContextStorage:
             Base64 encoded string of the image
         """
         buffered = BytesIO()
-        image.save(buffered, format="PNG")
-        return base64.b64encode(buffered.getvalue()).decode('utf-8')
+        # Text on a white background compresses well even at the fastest deflate level,
+        # which encodes several times faster than the default level 6
+        image.save(buffered, format="PNG", compress_level=1)
+        # Encode straight from the buffer instead of a getvalue() copy of the PNG
+        with buffered.getbuffer() as png_view:
+            return base64.b64encode(png_view).decode('ascii')
 
 
 class GeminiImageContextChat:
     """Chat system using Gemini API with image-based context storage."""
     
+    # Text sent around the context image; only the user's message is filled in
+    CONTEXT_PROMPT_HEADER = "Here is our conversation history as an image:"
+    CONTEXT_PROMPT_TRAILER = "\nUser's new message: {}\n\nPlease respond naturally based on the conversation history shown in the image."
+    
     def __init__(self, api_key: str, model_name: str = "gemini-2.0-flash-exp", 
-                 context_images_dir: str = "context_images"):
+                 context_images_dir: Optional[str] = "context_images",
+                 image_storage: Optional[ImageContextStorage] = None,
+                 verbose: bool = False):
         """
         Initialize the Gemini chat with image context.
         
         Args:
             api_key: Google API key for Gemini
             model_name: Gemini model to use
-            context_images_dir: Directory to save context images (default: "context_images")
+            context_images_dir: Directory to save a debug copy of each context image sent
+                (default: "context_images"); None skips saving them
+            image_storage: Renderer to use, e.g. one shared between chats (default: a new one)
+            verbose: Print a token usage estimate before every API call (default: False)
         """
         genai.configure(api_key=api_key)
         self.model = genai.GenerativeModel(model_name)
-        self.image_storage = ImageContextStorage()
+        self.image_storage = image_storage if image_storage is not None else ImageContextStorage()
         self.conversation_history: List[Dict[str, str]] = []
-        self.context_image: Image.Image = None
+        self._context_image: Optional[Image.Image] = None
+        self.context_image_messages = 0  # how many history messages _context_image shows
+        self._total_chars = 0  # characters across conversation_history, kept by add_message
         self.api_call_count = 0
         self.context_images_dir = context_images_dir
+        self.verbose = verbose
         
         # Create context images directory if it doesn't exist
-        os.makedirs(context_images_dir, exist_ok=True)
+        if context_images_dir is not None:
+            os.makedirs(context_images_dir, exist_ok=True)
     
     def add_message(self, role: str, content: str):
         """
@@ -203,11 +464,32 @@ class GeminiImageContextChat:
             'role': role,
             'content': content
         })
+        self._total_chars += len(content)
+        # The context image is brought up to date the next time it is read
+    
+    @property
+    def context_image(self) -> Optional[Image.Image]:
+        """
+        Image of the entire conversation history, drawn on first use after it changes.
         
-        # Update context image
-        self.context_image = self.image_storage.messages_to_image(
-            self.conversation_history
-        )
+        Only the messages added since the last render are drawn; they are appended
+        below the previous image.
+        
+        Returns:
+            PIL Image of the conversation history, or None if it is empty
+        """
+        if self.context_image_messages < len(self.conversation_history):
+            if self._context_image is not None and self.context_image_messages:
+                self._context_image = self.image_storage.append_messages_to_image(
+                    self._context_image,
+                    self.conversation_history[self.context_image_messages:]
+                )
+            else:
+                self._context_image = self.image_storage.messages_to_image(
+                    self.conversation_history
+                )
+            self.context_image_messages = len(self.conversation_history)
+        return self._context_image
     
     def send_message(self, user_message: str) -> str:
         """
@@ -219,115 +501,146 @@ class GeminiImageContextChat:
         Returns:
             The model's response
         """
+        previous_context_image = None
+        
+        # Prepare the prompt with context image
+        if len(self.conversation_history) > 0:
+            # Context image of the entire chat history (all messages in conversation_history)
+            # The image contains all previous messages at 768px width, height scales as needed;
+            # only the last turn's messages are drawn, onto the image sent with the previous call
+            previous_context_image = self.context_image
+            
+            # Add user message to history (for future context)
+            self.add_message('user', user_message)
+            
+            prompt_parts = [
+                self.CONTEXT_PROMPT_HEADER,
+                previous_context_image,
+                self.CONTEXT_PROMPT_TRAILER.format(user_message)
+            ]
+        else:
+            # First message, no context image needed
+            # Add user message to history
+            self.add_message('user', user_message)
+            prompt_parts = [user_message]
+        
+        # Increment API call counter
+        self.api_call_count += 1
+        
+        # Token accounting only feeds the printed estimate
+        token_report = self._token_report(previous_context_image, user_message) if self.verbose else None
+        
+        # Save the context image sent with this call (if there is one and saving is on)
+        if previous_context_image is not None and self.context_images_dir is not None:
+            image_filename = f"context_{self.api_call_count}.png"
+            image_path = os.path.join(self.context_images_dir, image_filename)
+            # Debug copy only, the fastest deflate level is plenty
+            buffered = BytesIO()
+            previous_context_image.save(buffered, format="PNG", compress_level=1)
+            png_bytes = buffered.getvalue()
+            with open(image_path, 'wb') as f:
+                f.write(png_bytes)
+            print(f"Context image saved: {image_path}")
+            # Send the PNG just written rather than have the SDK encode the image again
+            prompt_parts[1] = {'mime_type': 'image/png', 'data': png_bytes}
+        
+        # Print token estimates before API call, as one write rather than a print per line
+        if token_report is not None:
+            sys.stdout.write(token_report)
+        
+        # Generate response
+        response = self.model.generate_content(prompt_parts)
+        model_response = response.text
+        
+        # Add model response to history
+        self.add_message('model', model_response)
+        
+        return model_response
+    
+    def _token_report(self, context_image: Optional[Image.Image], user_message: str) -> str:
+        """
+        Work out the token usage estimate for the call send_message is about to make.
+        
+        Args:
+            context_image: Context image sent with the call, or None for the first message
+            user_message: The user's message, already added to conversation_history
+            
+        Returns:
+            The estimate as printable text
+        """
         # Calculate token usage before API call
         vision_tokens = 0
         text_tokens_for_context = 0
-        prompt_text_tokens = 0
         user_message_tokens = 0
         text_equivalent_total = 0
         token_savings = 0
         
-        # Prepare the prompt with context image
-        if len(self.conversation_history) > 0:
-            # Create context image from entire chat history (all messages in conversation_history)
-            # The image will contain all previous messages at 768px width, height scales as needed
-            previous_context_image = self.image_storage.messages_to_image(
-                self.conversation_history
-            )
-            
+        if context_image is not None:
             # Estimate vision tokens for the context image
             # Formula: ceil(height / 768) * 258 tokens for 768px width image
-            vision_tokens = self.estimate_vision_tokens(previous_context_image, verbose=True)
-            
-            # Add user message to history (for future context)
-            self.add_message('user', user_message)
+            vision_tokens = self.estimate_vision_tokens(context_image, verbose=True)
             
             # Calculate Text Equivalent: total characters in ENTIRE chat history (including new user message) / 4
             # This represents what it would cost to send all messages as text
-            total_text_chars = sum(len(msg['content']) for msg in self.conversation_history)
+            total_text_chars = self._total_chars
             text_equivalent_total = total_text_chars // 4
             
             # Calculate text tokens for context image only (for display purposes)
-            context_text_chars = sum(len(msg['content']) for msg in self.conversation_history[:-1])  # Exclude the user message we just added
+            context_text_chars = self._total_chars - len(user_message)  # Exclude the user message
             text_tokens_for_context = context_text_chars // 4
             user_message_tokens = len(user_message) // 4
             
             # Prompt text includes wrapper text + user message for image method
-            prompt_text = "Here is our conversation history as an image:\nUser's new message: {}\n\nPlease respond naturally based on the conversation history shown in the image.".format(user_message)
-            prompt_text_tokens = self.estimate_text_tokens(prompt_text)
+            prompt_text_tokens = self.estimate_text_tokens_for_chars(
+                len(self.CONTEXT_PROMPT_HEADER) + len(self.CONTEXT_PROMPT_TRAILER.format(user_message))
+            )
             
             # Calculate token savings: Text Equivalent - (Vision Tokens + Prompt Text Tokens)
             # Formula: Token Savings = Text Equivalent - (Vision Tokens + Prompt Text Tokens)
             token_savings = text_equivalent_total - (vision_tokens + prompt_text_tokens)
-            
-            prompt_parts = [
-                "Here is our conversation history as an image:",
-                previous_context_image,
-                f"\nUser's new message: {user_message}\n\nPlease respond naturally based on the conversation history shown in the image."
-            ]
-            
-            # Save the context image that was actually sent
-            self.context_image = previous_context_image
         else:
-            # First message, no context image needed
-            # Add user message to history
-            self.add_message('user', user_message)
             prompt_text_tokens = self.estimate_text_tokens(user_message)
-            prompt_parts = [user_message]
-        
-        # Increment API call counter
-        self.api_call_count += 1
         
-        # Save context image before API call (if context image exists)
-        if self.context_image is not None:
-            image_filename = f"context_{self.api_call_count}.png"
-            image_path = os.path.join(self.context_images_dir, image_filename)
-            self.context_image.save(image_path)
-            print(f"Context image saved: {image_path}")
-        
-        # Print token estimates before API call
-        print(f"\n--- Token Usage Estimate (API Call #{self.api_call_count}) ---")
-        print(f"Vision tokens (context image): {vision_tokens}")
-        print(f"Text tokens (prompt text): {prompt_text_tokens}")
-        print(f"Total tokens for API call: {vision_tokens + prompt_text_tokens}")
+        report = [
+            f"\n--- Token Usage Estimate (API Call #{self.api_call_count}) ---",
+            f"Vision tokens (context image): {vision_tokens}",
+            f"Text tokens (prompt text): {prompt_text_tokens}",
+            f"Total tokens for API call: {vision_tokens + prompt_text_tokens}",
+        ]
         if text_tokens_for_context >= 0:  # Changed condition to show even for first message
             # Show breakdown for clarity
             if text_tokens_for_context > 0:
-                print(f"\nText Equivalent Breakdown:")
-                print(f"  Previous messages as text: {text_tokens_for_context} tokens")
-                print(f"  New user message as text: {user_message_tokens} tokens")
-                print(f"  Total text equivalent: {text_equivalent_total} tokens")
+                report += [
+                    "\nText Equivalent Breakdown:",
+                    f"  Previous messages as text: {text_tokens_for_context} tokens",
+                    f"  New user message as text: {user_message_tokens} tokens",
+                    f"  Total text equivalent: {text_equivalent_total} tokens",
+                ]
             else:
                 # First message case
                 text_equivalent_total = user_message_tokens
                 token_savings = 0  # No savings on first message
             
             if text_equivalent_total > 0:
-                print(f"\nToken Savings Calculation:")
-                print(f"  Formula: Token Savings = Text Equivalent - (Vision Tokens + Prompt Text Tokens)")
-                print(f"  Text Equivalent: {text_equivalent_total} tokens")
-                print(f"  Vision Tokens: {vision_tokens} tokens")
-                print(f"  Prompt Text Tokens: {prompt_text_tokens} tokens")
                 calculated_savings = text_equivalent_total - (vision_tokens + prompt_text_tokens)
-                print(f"  Calculation: {text_equivalent_total} - ({vision_tokens} + {prompt_text_tokens})")
-                print(f"  Calculation: {text_equivalent_total} - {vision_tokens + prompt_text_tokens} = {calculated_savings}")
-                print(f"  Token Savings: {token_savings} tokens")
+                report += [
+                    "\nToken Savings Calculation:",
+                    "  Formula: Token Savings = Text Equivalent - (Vision Tokens + Prompt Text Tokens)",
+                    f"  Text Equivalent: {text_equivalent_total} tokens",
+                    f"  Vision Tokens: {vision_tokens} tokens",
+                    f"  Prompt Text Tokens: {prompt_text_tokens} tokens",
+                    f"  Calculation: {text_equivalent_total} - ({vision_tokens} + {prompt_text_tokens})",
+                    f"  Calculation: {text_equivalent_total} - {vision_tokens + prompt_text_tokens} = {calculated_savings}",
+                    f"  Token Savings: {token_savings} tokens",
+                ]
                 
                 # Verify the calculation matches
                 if token_savings != calculated_savings:
-                    print(f"  ⚠️  WARNING: Mismatch! token_savings ({token_savings}) != calculated ({calculated_savings})")
+                    report.append(f"  ⚠️  WARNING: Mismatch! token_savings ({token_savings}) != calculated ({calculated_savings})")
                 else:
-                    print(f"  ✓ Verified: Token Savings = {token_savings} tokens")
-        print("----------------------------\n")
-        
-        # Generate response
-        response = self.model.generate_content(prompt_parts)
-        model_response = response.text
-        
-        # Add model response to history
-        self.add_message('model', model_response)
-        
-        return model_response
+                    report.append(f"  ✓ Verified: Token Savings = {token_savings} tokens")
+        report.append("----------------------------\n")
+        return "\n".join(report) + "\n"
     
     def save_context_image(self, filepath: str):
         """
@@ -365,11 +678,10 @@ class GeminiImageContextChat:
         height = image.height
         
         # Calculate tokens based on height: each 768px unit of height = 258 tokens
-        # Use ceiling division to round up
-        height_units = -(-height // 768)  # Ceiling division
-        total_tokens = height_units * 258
+        total_tokens = vision_tokens_for_size(width, height)
         
         if verbose:
+            height_units = total_tokens // 258
             print(f"  Image {width}x{height}:")
             print(f"    Width: {width}px (fixed at 768px)")
             print(f"    Height: {height}px")
@@ -385,11 +697,35 @@ class GeminiImageContextChat:
         Args:
             text: Text to estimate tokens for
             
+        Returns:
+            Estimated number of text tokens (using ~4 chars per token)
+        """
+        return self.estimate_text_tokens_for_chars(len(text))
+    
+    def estimate_text_tokens_for_chars(self, char_count: int) -> int:
+        """
+        Estimate text tokens from a character count, for text that is never joined into one string.
+        
+        Args:
+            char_count: Number of characters in the text
+            
         Returns:
             Estimated number of text tokens (using ~4 chars per token)
         """
         # Rough estimate: ~4 characters per token for English text
-        return len(text) // 4
+        return char_count // 4
+    
+    def estimate_text_tokens_batch(self, texts: List[str]) -> List[int]:
+        """
+        Estimate text tokens for many strings in one call.
+        
+        Args:
+            texts: Texts to estimate tokens for
+        
+        Returns:
+            Estimated number of text tokens for each text, in the same order
+        """
+        return text_tokens_for_texts(texts)
     
     def estimate_context_text_tokens(self) -> int:
         """
@@ -400,7 +736,7 @@ class GeminiImageContextChat:
         Returns:
             Estimated number of text tokens for full conversation history
         """
-        total_chars = sum(len(msg['content']) for msg in self.conversation_history)
+        total_chars = self._total_chars
         return total_chars // 4
     
     def get_context_stats(self) -> Dict[str, int]:
@@ -410,7 +746,7 @@ class GeminiImageContextChat:
         Returns:
             Dictionary with statistics
         """
-        total_text_chars = sum(len(msg['content']) for msg in self.conversation_history)
+        total_text_chars = self._total_chars
         
         stats = {
             'total_messages': len(self.conversation_history),
@@ -440,7 +776,7 @@ def main():
     
     # Initialize chat
     print("Initializing Gemini Chat with Image Context Storage...")
-    chat = GeminiImageContextChat(api_key)
+    chat = GeminiImageContextChat(api_key, verbose=True)
     
     print("\n" + "="*60)
     print("Gemini Image Context Chat")